@@ -4,84 +4,201 @@ from fivetran_connector_sdk import Operations as op
 from fivetran_connector_sdk import Logging as log
 
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import json
 import os
+import queue
 import sqlite3
 import threading
-from concurrent.futures import ThreadPoolExecutor, as_completed
-from datetime import datetime
-
-# global lock for writing the datasets.jsonl safely from threads
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from pathlib import Path
+
+try:
+    import orjson  # optional C encoder for the JSONL hot paths
+except ImportError:
+    orjson = None
+
+try:
+    import fcntl  # POSIX only; cross-process locking of the JSONL outputs
+except ImportError:
+    fcntl = None
+
+# global lock for append_jsonl_file writes from threads (in-process first line;
+# _locked_file adds an flock so other connector processes cannot interleave lines)
 _file_lock = threading.Lock()
 _OUTPUT_DIR = "output"
 _DATASETS_JSONL = os.path.join(_OUTPUT_DIR, "datasets.jsonl")
+_dirs_ready = set()  # parent dirs already created by append_jsonl_file this process
 _WAREHOUSE_DEFAULT = "files/warehouse.db/tester"  # best-effort default used by tester
 
+# datasets.jsonl lines are written in batches by a single writer thread per run
+_WRITE_BATCH_SIZE = 1000
+_EXPORT_BATCH_SIZE = 1000
+
+# shared HTTP session so page requests reuse a keep-alive connection; sized for the
+# single prefetch thread talking to the one catalog host
+_SESSION = requests.Session()
+_SESSION.mount(
+    "https://",
+    HTTPAdapter(
+        pool_connections=1,
+        pool_maxsize=1,
+        max_retries=Retry(total=3, backoff_factor=2, status_forcelist=[429, 500, 502, 503, 504]),
+    ),
+)
+
 # ---------------------------------------------------------------------
 # Helper: fetch a single page of datasets
 # ---------------------------------------------------------------------
-def fetch_datasets_page(start: int, page_size: int):
+# Pages are ordered by metadata_modified and keyed on the last timestamp seen
+# (keyset pagination), so `start` only skips rows tied on that timestamp
+# instead of growing with page depth. The id tiebreaker keeps tied rows in the
+# same order on every request so the skip always drops the rows already synced.
+def fetch_datasets_page(start: int, page_size: int, since_iso: str = None):
     BASE_URL = "https://catalog.data.gov/api/3/action/package_search"
-    params = {"start": start, "rows": page_size}
-    response = requests.get(BASE_URL, params=params, timeout=30)
+    params = {"start": start, "rows": page_size, "sort": "metadata_modified asc, id asc"}
+    if since_iso:
+        # Solr date ranges need the UTC "Z" suffix; CKAN timestamps omit it
+        since = since_iso if since_iso.endswith("Z") else since_iso + "Z"
+        params["fq"] = f"metadata_modified:[{since} TO *]"
+    response = _SESSION.get(BASE_URL, params=params, timeout=30)
     response.raise_for_status()
     data = response.json()
     return data.get("result", {}).get("results", [])
 
 
 # ---------------------------------------------------------------------
-# Helper: parse ISO8601 timestamps (handles trailing Z)
+# Helper: encode one JSONL line as UTF-8 bytes (orjson when installed)
+# ---------------------------------------------------------------------
+def _json_line(obj) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(obj, default=str) + b"\n"
+    return (json.dumps(obj, ensure_ascii=False, default=str) + "\n").encode("utf-8")
+
+
+# ---------------------------------------------------------------------
+# Helper: hold an exclusive flock on an open file (no-op where unsupported)
 # ---------------------------------------------------------------------
-def parse_iso8601(iso_str):
-    if not iso_str:
-        return None
+@contextmanager
+def _locked_file(fh):
+    if fcntl is None:
+        yield fh
+        return
+    fcntl.flock(fh.fileno(), fcntl.LOCK_EX)
     try:
-        if iso_str.endswith("Z"):
-            iso_str = iso_str[:-1]
-        return datetime.fromisoformat(iso_str)
-    except Exception:
-        log.warning(f"Invalid ISO8601 format encountered: {iso_str}")
-        return None
+        yield fh
+        fh.flush()  # data must reach the file before another process gets the lock
+    finally:
+        fcntl.flock(fh.fileno(), fcntl.LOCK_UN)
 
 
 # ---------------------------------------------------------------------
-# Helper: safe append to JSONL from any thread
+# Helper: safe append to JSONL from any thread or process
 # ---------------------------------------------------------------------
 def append_jsonl_file(path: str, obj: dict):
-    # Ensure directory exists
-    os.makedirs(os.path.dirname(path), exist_ok=True)
+    # Ensure directory exists (once per directory, not on every append)
+    parent = os.path.dirname(path)
+    if parent not in _dirs_ready:
+        os.makedirs(parent, exist_ok=True)
+        _dirs_ready.add(parent)
     with _file_lock:
-        with open(path, "a", encoding="utf-8") as fh:
-            json.dump(obj, fh, ensure_ascii=False, default=str)
-            fh.write("\n")
+        with open(path, "ab") as fh, _locked_file(fh):
+            fh.write(_json_line(obj))
 
 
 # ---------------------------------------------------------------------
-# Helper: process a dataset record and upsert it
+# Helper: background writer for datasets.jsonl (file opened once per run)
 # ---------------------------------------------------------------------
-def process_dataset_record(ds):
+def _writer_loop(path: str, write_q: queue.Queue, errors: list):
+    done = False
     try:
-        formatted = {
-            "id": ds.get("id"),
-            "name": ds.get("name"),
-            "title": ds.get("title"),
-            "metadata_created": ds.get("metadata_created"),
-            "metadata_modified": ds.get("metadata_modified"),
-            "organization": ds.get("organization", {}).get("title") if ds.get("organization") else None,
-            "num_resources": len(ds.get("resources", [])),  # INT
-            "tags": [tag.get("name") for tag in ds.get("tags", [])],  # JSON array
-        }
+        with open(path, "ab") as fh:
+            while not done:
+                # block for one item, then drain whatever else is already queued
+                batch = [write_q.get()]
+                while batch[-1] is not None and len(batch) < _WRITE_BATCH_SIZE:
+                    try:
+                        batch.append(write_q.get_nowait())
+                    except queue.Empty:
+                        break
+
+                done = batch[-1] is None
+                if done:
+                    batch.pop()
+                if batch:
+                    with _locked_file(fh):
+                        fh.write(b"".join(_json_line(o) for o in batch))
+    except Exception as e:
+        errors.append(e)
+        # if the sentinel has not been read yet, keep consuming up to it so
+        # stop_jsonl_writer never waits on a dead writer
+        while not done:
+            done = write_q.get() is None
 
-        # Upsert into destination table
-        op.upsert(table="datasets", data=formatted)
 
-        # Append to local JSONL file for debugging (thread-safe)
-        append_jsonl_file(_DATASETS_JSONL, formatted)
+def start_jsonl_writer(path: str):
+    # each run gets its own queue, so nothing left over from a failed run can leak into the next
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    write_q = queue.Queue()
+    errors = []
+    thread = threading.Thread(target=_writer_loop, args=(path, write_q, errors), daemon=True)
+    thread.start()
+    return write_q, thread, errors
 
-    except Exception as e:
-        # protect against missing id
-        ds_id = ds.get("id") if isinstance(ds, dict) else None
-        log.severe(f"Error processing dataset {ds_id}", e)
+
+def stop_jsonl_writer(writer, raise_errors: bool = True):
+    write_q, thread, errors = writer
+    # sentinel tells the writer to flush what it has and close the file
+    write_q.put(None)
+    thread.join()
+    if errors and raise_errors:
+        raise errors[0]
+
+
+# ---------------------------------------------------------------------
+# Helper: flatten a page of raw datasets in one pass (runs on the main thread)
+# ---------------------------------------------------------------------
+def flatten_records(results: list) -> list:
+    g = dict.get
+    formatted = []
+    for ds in results:
+        try:
+            formatted.append({
+                "id": g(ds, "id"),
+                "name": g(ds, "name"),
+                "title": g(ds, "title"),
+                "metadata_created": g(ds, "metadata_created"),
+                "metadata_modified": g(ds, "metadata_modified"),
+                "organization": g(g(ds, "organization") or {}, "title"),
+                "num_resources": len(g(ds, "resources") or ()),  # INT
+                "tags": [g(tag, "name") for tag in g(ds, "tags") or ()],  # JSON array
+            })
+        except Exception as e:
+            # skip only the malformed record; the rest of the page still syncs
+            ds_id = ds.get("id") if isinstance(ds, dict) else None
+            log.severe(f"Error processing dataset {ds_id}", e)
+    return formatted
+
+
+# ---------------------------------------------------------------------
+# Helper: upsert one page of flattened dataset records
+# ---------------------------------------------------------------------
+def upsert_dataset_page(formatted: list, write_q: queue.Queue):
+    # op.upsert takes a single row, so the page is emitted in one tight loop
+    upsert = op.upsert
+    for rec in formatted:
+        try:
+            # Upsert into destination table
+            upsert(table="datasets", data=rec)
+        except Exception as e:
+            log.severe(f"Error processing dataset {rec.get('id')}", e)
+            continue
+
+        # Queue for the local JSONL debug file (written by the writer thread)
+        write_q.put(rec)
 
 
 # ---------------------------------------------------------------------
@@ -115,17 +232,19 @@ def find_sqlite_file(path: str):
         return path
     # if the path points to an existing directory, try to find a file inside
     if os.path.isdir(path):
-        for fname in os.listdir(path):
-            candidate = os.path.join(path, fname)
-            if os.path.isfile(candidate):
+        # single scandir pass; DirEntry.is_file() reuses the readdir type info
+        fallback = None
+        with os.scandir(path) as entries:
+            for entry in entries:
+                if not entry.is_file():
+                    continue
                 # prefer .db/.sqlite extensions, but accept any file as fallback
-                if fname.endswith(".db") or fname.endswith(".sqlite"):
-                    return candidate
-        # fallback: return first file found
-        for fname in os.listdir(path):
-            candidate = os.path.join(path, fname)
-            if os.path.isfile(candidate):
-                return candidate
+                if entry.name.endswith((".db", ".sqlite")):
+                    return entry.path
+                if fallback is None:
+                    fallback = entry.path
+        if fallback:
+            return fallback
     # try common alternative
     alt = path + ".db"
     if os.path.isfile(alt):
@@ -153,23 +272,27 @@ def export_warehouse_to_jsonl(db_path=_WAREHOUSE_DEFAULT, out_path=os.path.join(
         return
 
     try:
-        conn = sqlite3.connect(db_file)
+        # read-only: the export never writes, so SQLite can skip write locking;
+        # a large page cache and mmap keep big table scans off the read() path
+        conn = sqlite3.connect(Path(db_file).resolve().as_uri() + "?mode=ro", uri=True)
+        conn.executescript("PRAGMA cache_size=-262144; PRAGMA mmap_size=268435456; PRAGMA temp_store=MEMORY;")
         cursor = conn.cursor()
 
         # Get user tables (skip sqlite internal tables)
         cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name NOT LIKE 'sqlite_%';")
         tables = [row[0] for row in cursor.fetchall()]
 
-        with open(out_path, "w", encoding="utf-8") as out_file:
+        # stream each table in fixed-size batches instead of loading it whole
+        cursor.arraysize = _EXPORT_BATCH_SIZE
+        with open(out_path, "wb") as out_file:
             for table_name in tables:
                 cursor.execute(f"SELECT * FROM '{table_name}';")
-                rows = cursor.fetchall()
                 columns = [col[0] for col in cursor.description] if cursor.description else []
-                for row in rows:
-                    record = dict(zip(columns, row))
-                    record["_table"] = table_name
-                    json.dump(record, out_file, ensure_ascii=False, default=str)
-                    out_file.write("\n")
+                while True:
+                    rows = cursor.fetchmany()
+                    if not rows:
+                        break
+                    out_file.writelines(_json_line({**dict(zip(columns, row)), "_table": table_name}) for row in rows)
 
         conn.close()
         log.info(f"Warehouse exported successfully to {out_path} (db_file: {db_file})")
@@ -188,9 +311,15 @@ def update(configuration: dict, state: dict):
     # ensure output dir exists up front so files are created predictably
     os.makedirs(_OUTPUT_DIR, exist_ok=True)
 
-    PAGE_SIZE = int(configuration.get("page_size", "100"))
+    # Tuning knob:
+    #   page_size - rows per package_search call (CKAN caps this at 1000); bigger pages
+    #               mean fewer round-trips at the cost of a slower individual request
+    # The former "parallelism" knob was removed: pages are fetched by one prefetch
+    # thread and upserted on this thread, so there is no worker pool left to size.
+    PAGE_SIZE = int(configuration.get("page_size", "1000"))
     MAX_ROWS = int(configuration.get("max_rows", "1000"))
-    PARALLELISM = int(configuration.get("parallelism", "4"))
+    if "parallelism" in configuration:
+        log.warning("Configuration key 'parallelism' is no longer used and will be ignored")
 
     # Reset JSONL file for new run (safe even if it does not exist)
     try:
@@ -199,47 +328,59 @@ def update(configuration: dict, state: dict):
     except Exception as e:
         log.warning(f"Could not remove {_DATASETS_JSONL} before run: {e}")
 
-    start = state.get("last_start", 0)
+    # keyset cursor: last metadata_modified synced + rows already taken at that timestamp.
+    # The server only returns rows at or after it, so nothing is filtered client-side.
+    # State saved before the cursor existed starts from the beginning: upserts are keyed
+    # on id, so re-sending rows is harmless, while seeding from last_run would skip rows.
+    cursor = state.get("cursor")
+    start = state.get("cursor_skip", 0) if cursor is not None else 0
     total_fetched = 0
 
-    last_run_iso = state.get("last_run")
-    last_run_dt = parse_iso8601(last_run_iso)
-
-    while True:
-        try:
-            results = fetch_datasets_page(start, PAGE_SIZE)
-        except Exception as e:
-            log.severe(f"Failed to fetch datasets page starting at {start}", e)
-            break
-
-        if not results:
-            log.info("No more datasets to fetch")
-            break
-
-        with ThreadPoolExecutor(max_workers=PARALLELISM) as executor:
-            futures = []
-            for ds in results:
-                mod_dt = parse_iso8601(ds.get("metadata_modified"))
-                if last_run_dt and mod_dt and mod_dt <= last_run_dt:
-                    continue
-                futures.append(executor.submit(process_dataset_record, ds))
-
-            for f in as_completed(futures):
+    writer = start_jsonl_writer(_DATASETS_JSONL)
+    write_q = writer[0]
+    try:
+        # a single background thread prefetches the next page; upserts run on this thread
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            next_page = executor.submit(fetch_datasets_page, start, PAGE_SIZE, cursor)
+            while True:
                 try:
-                    f.result()
+                    results = next_page.result()
                 except Exception as e:
-                    log.severe("Error in processing dataset future", e)
+                    log.severe(f"Failed to fetch datasets page after {cursor} (skip {start})", e)
+                    break
+
+                if not results:
+                    log.info("No more datasets to fetch")
+                    break
+
+                total_fetched += len(results)
+
+                # advance the cursor to this page's last timestamp, skipping rows tied on it
+                last_modified = results[-1].get("metadata_modified")
+                tied = sum(1 for ds in results if ds.get("metadata_modified") == last_modified)
+                start = start + tied if last_modified == cursor else tied
+                cursor = last_modified
+
+                # request the next page now so its round-trip overlaps this page's processing
+                next_page = None
+                if total_fetched < MAX_ROWS:
+                    next_page = executor.submit(fetch_datasets_page, start, PAGE_SIZE, cursor)
 
-        total_fetched += len(results)
-        start += PAGE_SIZE
+                upsert_dataset_page(flatten_records(results), write_q)
 
-        if total_fetched >= MAX_ROWS:
-            log.info(f"Reached max_rows limit: {MAX_ROWS}")
-            break
+                if next_page is None:
+                    log.info(f"Reached max_rows limit: {MAX_ROWS}")
+                    break
+    except BaseException:
+        # the body's own exception wins; a writer error would only mask it
+        stop_jsonl_writer(writer, raise_errors=False)
+        raise
+    stop_jsonl_writer(writer)
 
     # Save connector state
-    state["last_start"] = start
-    state["last_run"] = datetime.now().isoformat()
+    state["cursor"] = cursor
+    state["cursor_skip"] = start
+    state["last_run"] = datetime.now(timezone.utc).isoformat()
     op.checkpoint(state)
 
     # Export the warehouse database to a readable JSONL file (always produces an artifact)
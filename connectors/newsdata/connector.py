@@ -1,6 +1,18 @@
 import json 
+import queue
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
 from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
 import requests as rq
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+try:
+    import orjson  # optional C parser/encoder for responses, cleansing and FIF writes
+except ImportError:
+    orjson = None
 
 # Import required classes from fivetran_connector_sdk
 from fivetran_connector_sdk import Connector
@@ -12,6 +24,28 @@ API_BASE_URL = "https://newsdata.io/api/1/latest"
 TABLE_NAME = "news_articles"
 # NEW CONSTANT: Defines the predictable output file name
 OUTPUT_DATA_PATH = "articles_output.jsonl" 
+# Upper bound on keyword requests in flight at once (stays within the session's connection pool)
+MAX_CONCURRENT_REQUESTS = 16
+# Output file buffer size and max lines held in memory before a flush
+WRITE_BUFFER_SIZE = 1 << 16
+WRITE_BATCH_SIZE = 1000
+# Max batches waiting for the background writer before producers block
+WRITE_QUEUE_SIZE = 1024
+# Soft cap on article ids remembered for dedup within one sync (least recently seen evicted)
+MAX_SEEN_IDS = 500_000
+
+# Shared session: keep-alive connections to the one API host plus urllib3 retries with backoff
+_SESSION = rq.Session()
+_SESSION.mount(
+    "https://",
+    HTTPAdapter(
+        pool_connections=1,
+        pool_maxsize=MAX_CONCURRENT_REQUESTS,
+        max_retries=Retry(total=3, backoff_factor=2, status_forcelist=[429, 500, 502, 503, 504]),
+    ),
+)
+# (connect, read) timeouts in seconds
+REQUEST_TIMEOUT = (3.05, 30)
 
 
 # --- Schema Definition (Unchanged) ---
@@ -30,6 +64,87 @@ def validate_configuration(configuration: dict):
         raise ValueError("Missing required configuration value: 'api_key'")
 
 
+# --- JSON encoding helpers (orjson when installed, stdlib json otherwise) ---
+def _json_bytes(obj) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj).encode('utf-8')
+
+
+def _json_str(obj) -> str:
+    if orjson is not None:
+        return orjson.dumps(obj).decode('utf-8')
+    return json.dumps(obj)
+
+
+# --- Data Cleansing: flatten list/dict values, keyed on exact type ---
+def clean_article(article: dict) -> dict:
+    cleaned_article = {}
+    for key, value in article.items():
+        # identity checks on type(); most fields are primitives and fall through to else
+        t = type(value)
+        if t is list:
+            cleaned_article[key] = ",".join(map(str, value))
+        elif t is dict:
+            cleaned_article[key] = _json_str(value)
+        else:
+            cleaned_article[key] = value
+    return cleaned_article
+
+
+# --- API Request for a single keyword (runs on a worker thread) ---
+def fetch_articles(api_endpoint: str, base_params: dict, keyword: str):
+    response = _SESSION.get(api_endpoint, params={**base_params, "q": keyword}, timeout=REQUEST_TIMEOUT)
+    response.raise_for_status() 
+    if orjson is None:
+        return response.json().get("results", [])
+    try:
+        return orjson.loads(response.content).get("results", [])
+    except orjson.JSONDecodeError as e:
+        # keep the failure a RequestException so the per-keyword handler still catches it
+        raise rq.exceptions.InvalidJSONError(str(e), response=response) from e
+
+
+# --- Background file writer: overlaps disk writes with parsing and cleansing ---
+@contextmanager
+def background_writer(f, state: dict):
+    """
+    Yields a bounded queue of (lines, keyword) items that a worker thread writes to f.
+    A non-None keyword marks that keyword as complete: its lines are flushed and the
+    keyword is checkpointed, so a checkpoint never runs ahead of the data on disk.
+    """
+    writer_q = queue.Queue(maxsize=WRITE_QUEUE_SIZE)
+    errors = []
+
+    def drain():
+        while (item := writer_q.get()) is not None:
+            if errors:
+                continue  # keep draining so producers never block on a failed writer
+            lines, keyword = item
+            try:
+                if lines:
+                    # one join builds the whole newline-terminated chunk; the trailing
+                    # empty item supplies the final newline without a per-line concat
+                    lines.append(b'')
+                    f.write(b'\n'.join(lines))
+                if keyword is not None:
+                    f.flush()
+                    state["processed_keywords"] = state.get("processed_keywords", []) + [keyword]
+                    op.checkpoint(state=state)
+            except Exception as e:
+                errors.append(e)
+
+    thread = threading.Thread(target=drain, daemon=True)
+    thread.start()
+    try:
+        yield writer_q
+    finally:
+        writer_q.put(None)
+        thread.join()
+    if errors:
+        raise errors[0]
+
+
 # --- Main Sync Logic (Manual File Write) ---
 def update(configuration: dict, state: dict): 
     """
@@ -43,45 +158,64 @@ def update(configuration: dict, state: dict):
     api_key = configuration.get("api_key")
     query_terms_str = configuration.get("query_term", "fivetran") 
     api_endpoint = configuration.get("api_endpoint", API_BASE_URL)
+    # Query parameters shared by every keyword request, built once per sync
+    base_params = {
+        "apikey": api_key,
+        "language": "en" 
+    }
 
     keywords = [term.strip() for term in query_terms_str.split(',') if term.strip()]
-    all_unique_articles = {} 
+
+    # Resume support: keywords fully written by an interrupted sync are skipped and
+    # the output file is appended to instead of truncated
+    processed_keywords = state.get("processed_keywords", [])
+    if processed_keywords:
+        log.info(f"Resuming sync; skipping already processed keywords: {processed_keywords}")
+    keywords = [k for k in keywords if k not in processed_keywords]
+    file_mode = 'ab' if processed_keywords else 'wb'
+
+    # 64-bit hashes of article_ids already written this run, kept as a bounded LRU. Only
+    # membership is needed, so neither the article bodies nor the id strings are kept alive.
+    # An evicted id that shows up again is simply re-upserted under the same primary key.
+    seen_ids = OrderedDict()
+    unique_written = 0
 
     # We must explicitly open the file for writing before the loop starts
     try:
-        with open(OUTPUT_DATA_PATH, 'w', encoding='utf-8') as f:
-            
-            for keyword in keywords:
-                log.info(f"Fetching data for query: '{keyword}'")
-
-                params = {
-                    "apikey": api_key,
-                    "q": keyword, 
-                    "language": "en" 
-                }
-                
+        with open(OUTPUT_DATA_PATH, file_mode, buffering=WRITE_BUFFER_SIZE) as f, \
+                background_writer(f, state) as writer_q, \
+                ThreadPoolExecutor(max_workers=max(1, min(len(keywords), MAX_CONCURRENT_REQUESTS))) as executor:
+
+            # Dispatch every keyword request up front; total wait is ~max(RTT) instead of sum(RTT)
+            log.info(f"Fetching data for queries: {keywords}")
+            futures = [executor.submit(fetch_articles, api_endpoint, base_params, keyword) for keyword in keywords]
+
+            # Encoded lines are collected per keyword and handed to the writer as one batch
+            batch = []
+
+            # Results are consumed in keyword order so dedup/write behaviour is unchanged
+            for keyword, future in zip(keywords, futures):
+                log.info(f"Processing results for query: '{keyword}'")
+
                 # --- API Request ---
                 try:
-                    response = rq.get(api_endpoint, params=params)
-                    response.raise_for_status() 
-                    articles = response.json().get("results", [])
+                    articles = future.result()
                     log.info(f"Retrieved {len(articles)} articles for '{keyword}'.")
 
                     # --- Deduplication and Writing ---
                     for article in articles:
                         article_id = article.get("article_id")
-                        if article_id and article_id not in all_unique_articles:
-                            all_unique_articles[article_id] = article
+                        id_hash = hash(article_id) if article_id else None
+                        if id_hash in seen_ids:
+                            seen_ids.move_to_end(id_hash)
+                        elif id_hash is not None:
+                            seen_ids[id_hash] = None
+                            unique_written += 1
+                            if len(seen_ids) > MAX_SEEN_IDS:
+                                seen_ids.popitem(last=False)
                             
-                            # Data Cleansing Logic (moved outside the loop for simplicity in this example)
-                            cleaned_article = {}
-                            for key, value in article.items():
-                                if isinstance(value, list):
-                                    cleaned_article[key] = ",".join(map(str, value))
-                                elif isinstance(value, dict):
-                                    cleaned_article[key] = json.dumps(value)
-                                else:
-                                    cleaned_article[key] = value
+                            # Data Cleansing Logic
+                            cleaned_article = clean_article(article)
 
                             # Manual FIF Record Creation
                             fif_record = {
@@ -89,19 +223,30 @@ def update(configuration: dict, state: dict):
                                 "table": TABLE_NAME,
                                 "operation": "UPSERT" 
                             }
-                            # Write JSON Line to the file
-                            f.write(json.dumps(fif_record) + '\n')
+                            # Queue the JSON Line for this keyword's write (newline added by the writer)
+                            batch.append(_json_bytes(fif_record))
+                            if len(batch) >= WRITE_BATCH_SIZE:
+                                writer_q.put((batch, None))
+                                batch = []
+
+                    # The writer checkpoints the keyword once its lines are on disk,
+                    # so a crash does not redo completed keywords
+                    writer_q.put((batch, keyword))
+                    batch = []
                             
                 except rq.exceptions.RequestException as e:
                     log.severe(f"API request failed for keyword '{keyword}': {e}. Continuing.")
                 
-            log.info(f"Total unique articles processed and written to {OUTPUT_DATA_PATH}.")
+            log.info(f"Total unique articles processed and written to {OUTPUT_DATA_PATH}: {unique_written}.")
 
     except Exception as e:
         log.severe(f"Fatal error during file write or sync: {e}")
         raise # Re-raise the exception to fail the sync process
 
-    # 5. Checkpoint the new state (Still required by the SDK)
+    # 5. Checkpoint the new state (Still required by the SDK). The sync reached the end, so
+    # the resume list is cleared and the next sync starts fresh.
+    state.pop("processed_keywords", None)
+    state["last_run_ts"] = datetime.now().isoformat()
     op.checkpoint(state=state) 
     
     log.info("Successfully finished sync. Check 'articles_output.jsonl' for data.")